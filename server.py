@@ -1,43 +1,74 @@
 import sys
 import os
-import json
 import base64
+import bisect
 import io
 import ast
+import re
+import importlib.util
 import asyncio
 import logging
+import multiprocessing
+import traceback
 import sqlite3
 import hashlib
+import hmac
+import secrets
+import queue
+import threading
+import time
+import zlib
 from html import escape
-from contextlib import redirect_stdout
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, redirect_stdout
 
 # --- Package Installation Check ---
 try:
     import fastapi
     import uvicorn
-    from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
-    from fastapi import Request, Cookie, Response
-    from starlette.websockets import WebSocket, WebSocketDisconnect
+    from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, FileResponse
+    from fastapi import Request, Response, Depends, HTTPException
+    from starlette.exceptions import HTTPException as StarletteHTTPException
+    from fastapi.concurrency import run_in_threadpool
+    import anyio.to_thread
+    from starlette.websockets import WebSocket, WebSocketDisconnect, WebSocketState
     import matplotlib
     matplotlib.use('Agg')
     import matplotlib.pyplot as plt
     import pandas as pd
     import jedi
+    from itsdangerous import TimestampSigner, BadSignature
+    import orjson
+    import zstandard as zstd
 except ImportError:
-    print("Installing required packages: fastapi uvicorn python-multipart matplotlib pandas jedi")
-    os.system(f'"{sys.executable}" -m pip install "fastapi[all]" uvicorn python-multipart matplotlib pandas jedi')
+    print("Installing required packages: fastapi uvicorn python-multipart matplotlib pandas jedi itsdangerous orjson zstandard")
+    os.system(f'"{sys.executable}" -m pip install "fastapi[all]" "uvicorn[standard]" python-multipart matplotlib pandas jedi itsdangerous orjson zstandard')
     import fastapi
     import uvicorn
-    from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
-    from fastapi import Request, Cookie, Response
-    from starlette.websockets import WebSocket, WebSocketDisconnect
+    from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, FileResponse
+    from fastapi import Request, Response, Depends, HTTPException
+    from starlette.exceptions import HTTPException as StarletteHTTPException
+    from fastapi.concurrency import run_in_threadpool
+    import anyio.to_thread
+    from starlette.websockets import WebSocket, WebSocketDisconnect, WebSocketState
     import matplotlib
     matplotlib.use('Agg')
     import matplotlib.pyplot as plt
     import pandas as pd
     import jedi
+    from itsdangerous import TimestampSigner, BadSignature
+    import orjson
+    import zstandard as zstd
 
-app = fastapi.FastAPI()
+class ORJSONResponse(JSONResponse):
+    # Same as fastapi.responses.ORJSONResponse, which newer FastAPI releases deprecate
+    def render(self, content):
+        return orjson.dumps(content)
+
+app = fastapi.FastAPI(default_response_class=ORJSONResponse)
 logging.getLogger('websockets').setLevel(logging.ERROR)
 
 # --- Global Settings ---
@@ -45,19 +76,51 @@ logging.getLogger('websockets').setLevel(logging.ERROR)
 global_settings = {
     "enable_autocomplete": True
 }
+# Bumped on every change so get_settings knows when to re-encode its cached body
+settings_version = 0
+_settings_body = (None, b'')
+
+# /api/teacher/info results keyed by user id: (expires_at, info). Dashboards poll this.
+TEACHER_INFO_TTL = 1.0
+_teacher_info_cache = {}
 
 # --- Database Setup ---
 DB_NAME = 'lms.db'
+DB_POOL_SIZE = 8
 
-def get_db_conn():
-    conn = sqlite3.connect(DB_NAME)
+# Long-lived connections shared by all requests, filled once by init_db_pool()
+DB_POOL = queue.Queue(maxsize=DB_POOL_SIZE)
+
+def _create_db_conn():
+    # Every query is a string literal, so a large statement cache keeps them all prepared
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
+    # Per-connection tuning, applied once when the connection is created
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
     return conn
 
-def init_db():
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    
+def init_db_pool():
+    while not DB_POOL.full():
+        DB_POOL.put(_create_db_conn())
+
+@contextmanager
+def get_db_conn():
+    conn = DB_POOL.get()
+    try:
+        yield conn
+    except Exception:
+        conn.rollback() # Never hand a half-finished transaction to the next request
+        raise
+    finally:
+        DB_POOL.put(conn)
+
+def _migrate_v1(cursor):
+    # Base schema. Databases from before user_version tracking already have some of
+    # these tables and columns, so every statement here has to be idempotent.
+
     # Users Table
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS users (
@@ -82,11 +145,7 @@ def init_db():
     except sqlite3.OperationalError:
         pass # Column already exists
 
-    # Drop old tables for schema recreation (dev only)
-    cursor.execute("DROP TABLE IF EXISTS assignments")
-    cursor.execute("DROP TABLE IF EXISTS submissions")
-
-    # Assignments Table (New Schema)
+    # Assignments Table
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS assignments (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -100,7 +159,7 @@ def init_db():
     );
     ''')
     
-    # Submissions Table (New Schema)
+    # Submissions Table
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS submissions (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -126,134 +185,586 @@ def init_db():
         FOREIGN KEY (user_id) REFERENCES users (id)
     );
     ''')
+
+    # Indexes for the hot foreign-key lookups
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sub_assign_stud ON submissions(assignment_id, student_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sub_student ON submissions(student_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_assign_sem_sub ON assignments(semester, subject)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tickets_user ON tickets(user_id, created_at DESC)")
+
+def _migrate_v2(cursor):
+    # answers/grades become zstd-compressed JSON. The columns keep their TEXT
+    # declaration: TEXT affinity stores BLOB values untouched, so no table rebuild
+    rows = cursor.execute("SELECT id, answers, grades FROM submissions WHERE typeof(answers) = 'text'").fetchall()
+    cursor.executemany("UPDATE submissions SET answers = ?, grades = ? WHERE id = ?",
+                       [(compress_json_text(row[1]), compress_json_text(row[2]) if row[2] else None, row[0])
+                        for row in rows])
+
+# MIGRATIONS[i] upgrades the schema from user_version i to i + 1
+MIGRATIONS = [_migrate_v1, _migrate_v2]
+
+def init_db():
+    init_db_pool()
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        for target, migrate in enumerate(MIGRATIONS[version:], start=version + 1):
+            print(f"Migrating database schema to version {target}...")
+            migrate(cursor)
+            cursor.execute(f"PRAGMA user_version = {target}") # PRAGMA takes no bound parameters
+            conn.commit()
     
-    # Create a default admin user (if it doesn't exist)
-    cursor.execute("SELECT * FROM users WHERE username = 'admin'")
-    if not cursor.fetchone():
-        hashed_password = hashlib.sha256('admin123'.encode()).hexdigest()
-        cursor.execute("INSERT INTO users (username, password, role, name) VALUES (?, ?, ?, ?)",
-                       ('admin', hashed_password, 'admin', 'Administrator'))
-        print("Default admin user created with username 'admin' and password 'admin123'")
+        # Create a default admin user (if it doesn't exist)
+        cursor.execute("SELECT * FROM users WHERE username = 'admin'")
+        if not cursor.fetchone():
+            hashed_password = hash_password('admin123')
+            cursor.execute("INSERT INTO users (username, password, role, name) VALUES (?, ?, ?, ?)",
+                           ('admin', hashed_password, 'admin', 'Administrator'))
+            print("Default admin user created with username 'admin' and password 'admin123'")
     
-    conn.commit()
-    conn.close()
+        conn.commit()
+
+# --- Compressed JSON columns ---
+ZSTD_LEVEL = 3
+# Compressor/decompressor contexts are not safe to share between threads
+_zstd_local = threading.local()
+
+def _zstd_contexts():
+    contexts = getattr(_zstd_local, 'contexts', None)
+    if contexts is None:
+        contexts = _zstd_local.contexts = (zstd.ZstdCompressor(level=ZSTD_LEVEL), zstd.ZstdDecompressor())
+    return contexts
+
+def compress_json(value):
+    # Encodes any Python object, strings included, so request data always round-trips as JSON
+    return _zstd_contexts()[0].compress(orjson.dumps(value))
+
+def compress_json_text(text):
+    # For JSON text that is already stored, e.g. rows written before compression
+    return _zstd_contexts()[0].compress(text.encode())
+
+def json_text(value):
+    # Column value -> JSON text; uncompressed rows are passed through
+    if isinstance(value, bytes):
+        return _zstd_contexts()[1].decompress(value).decode()
+    return value
+
+def split_csv(value):
+    # semesters/subjects are stored as comma-separated text, e.g. "1, 2"
+    return [s.strip() for s in value.split(',')] if value else []
 
 # --- Hashing Utility ---
+SCRYPT_PARAMS = {'n': 2**14, 'r': 8, 'p': 1}
+
 def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+    # Stored as "<salt hex>$<scrypt hex>"
+    salt = secrets.token_bytes(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, **SCRYPT_PARAMS)
+    return f"{salt.hex()}${digest.hex()}"
+
+def is_legacy_hash(stored):
+    # Unsalted SHA-256 hex digests from before the scrypt migration
+    return '$' not in stored
+
+def verify_password(password, stored):
+    if is_legacy_hash(stored):
+        return hmac.compare_digest(stored, hashlib.sha256(password.encode()).hexdigest())
+    salt, digest = stored.split('$', 1)
+    candidate = hashlib.scrypt(password.encode(), salt=bytes.fromhex(salt), **SCRYPT_PARAMS)
+    return hmac.compare_digest(candidate.hex(), digest)
+
+# --- Session Signing ---
+# Set LMS_SECRET_KEY to keep sessions valid across restarts
+SECRET_KEY = os.environ.get("LMS_SECRET_KEY") or secrets.token_hex(32)
+SESSION_MAX_AGE = 12 * 60 * 60
+session_signer = TimestampSigner(SECRET_KEY, digest_method=hashlib.sha256)
+
+def sign_session(session):
+    # session is a small dict, e.g. {"id": 3, "role": "student", "semesters": [...], "subjects": [...]}
+    payload = base64.urlsafe_b64encode(orjson.dumps(session))
+    return session_signer.sign(payload).decode()
+
+def read_session(token):
+    # Returns the session dict, or None for a missing, forged or expired token
+    if not token:
+        return None
+    try:
+        payload = session_signer.unsign(token, max_age=SESSION_MAX_AGE)
+    except BadSignature:
+        return None
+    return orjson.loads(base64.urlsafe_b64decode(payload))
+
+# --- Execution Kernel (runs inside the worker processes) ---
+CODE_CACHE_SIZE = 512
+COMPLETION_CACHE_SIZE = 64
+PLOT_DPI = 80
+# The identifier being typed just before the cursor
+PARTIAL_NAME = re.compile(r'\w*$')
+
+def in_string(text):
+    # Whether a line prefix ends inside a string literal. Only single-line quoting is
+    # tracked, which covers dict keys and paths, the cases completions care about.
+    quote = None
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if quote:
+            if char == '\\':
+                i += 1 # Skip the escaped character
+            elif char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char == '#':
+            return False
+        i += 1
+    return quote is not None
+
+class Kernel:
+    # One per worker process, holding the namespace of every session pinned to it.
+    # Workers run one call at a time, so nothing here needs a lock.
+    def __init__(self):
+        self.namespaces = {}
+        # Reused for every cell's output
+        self._buf = io.StringIO()
+        # Completion indexes keyed by (session_id, context digest, line, column); see get_completions
+        self._completion_index = OrderedDict()
+        # Compiled cells keyed by source digest: (exec_code or None, eval_code or None)
+        self._code_cache = OrderedDict()
+
+    def _namespace(self, session_id):
+        namespace = self.namespaces.get(session_id)
+        if namespace is None:
+            namespace = self.namespaces[session_id] = {'plt': plt, 'pd': pd}
+        return namespace
+
+    def drop(self, session_id):
+        self.namespaces.pop(session_id, None)
+        self._invalidate_completions(session_id)
+
+    def execute(self, session_id, code):
+        session_locals = self._namespace(session_id)
+        self._invalidate_completions(session_id)
+        
+        buf = self._buf
+        buf.seek(0)
+        buf.truncate(0)
+        with redirect_stdout(buf):
+            try:
+                exec_code, eval_code = self._compile(code)
+                if eval_code:
+                    self._execute_with_result(exec_code, eval_code, session_locals, buf)
+                else:
+                    self._execute_exec_only(exec_code, session_locals)
+                self._render_figure(buf)
+            except (Exception, SystemExit): # exit() in a cell must not take the worker down
+                buf.seek(0)
+                buf.truncate(0)
+                buf.write(f'<div class="error">{escape(traceback.format_exc())}</div>')
+        return buf.getvalue()
+
+    def _execute_exec_only(self, exec_code, session_locals):
+        # Common case: the cell ends in a statement, so there is nothing to display
+        exec(exec_code, session_locals)
+
+    def _execute_with_result(self, exec_code, eval_code, session_locals, buf):
+        if exec_code:
+            exec(exec_code, session_locals)
+        result = eval(eval_code, session_locals)
+        if isinstance(result, pd.DataFrame):
+            buf.write(result.to_html())
+        elif result is not None:
+            buf.write(escape(str(result))) # Escape for XSS protection
+
+    def _render_figure(self, buf):
+        # get_fignums() is free; gcf() would allocate a figure for cells that never plot
+        if not plt.get_fignums():
+            return
+        fig = plt.gcf()
+        if fig.axes:
+            img_buf = io.BytesIO()
+            # No bbox_inches='tight': it costs an extra draw pass per figure
+            fig.savefig(img_buf, format='png', dpi=PLOT_DPI)
+            plt.close('all')
+            img_html = base64.b64encode(img_buf.getvalue()).decode()
+            buf.write(f'<img src="data:image/png;base64,{img_html}"><br>')
+
+    def _compile(self, code):
+        # Re-running a cell reuses its code objects instead of parsing it again
+        key = hashlib.blake2b(code.encode(), digest_size=16).digest()
+        cached = self._code_cache.get(key)
+        if cached:
+            self._code_cache.move_to_end(key)
+            return cached
+
+        tree = ast.parse(code)
+        if tree.body and isinstance(tree.body[-1], ast.Expr):
+            # Run everything but the last expression, then evaluate it for display
+            exec_code = None
+            if len(tree.body) > 1:
+                exec_code = compile(ast.Module(tree.body[:-1], type_ignores=[]), '<string>', 'exec')
+            eval_code = compile(ast.Expression(tree.body[-1].value), '<string>', 'eval')
+        else:
+            exec_code = compile(tree, '<string>', 'exec')
+            eval_code = None
+
+        self._code_cache[key] = (exec_code, eval_code)
+        if len(self._code_cache) > CODE_CACHE_SIZE:
+            self._code_cache.popitem(last=False)
+        return exec_code, eval_code
+
+    def _invalidate_completions(self, session_id):
+        # Running code can change what any name in the namespace resolves to
+        for key in [key for key in self._completion_index if key[0] == session_id]:
+            del self._completion_index[key]
+
+    def _build_completion_index(self, session_id, code, line, column):
+        # Everything Jedi offers at the cursor with no name typed yet, with Jedi's rank for each.
+        # Entries are sorted by lowercased name so that any typed prefix maps to one contiguous
+        # slice, which makes this a flattened trie.
+        interpreter = jedi.Interpreter(code, [self._namespace(session_id)])
+        names = [c.name for c in interpreter.complete(line=line + 1, column=column)]
+        entries = sorted((name.lower(), name, rank) for rank, name in enumerate(names))
+        return [entry[0] for entry in entries], entries
+
+    def _complete_directly(self, session_id, code, line, column):
+        # Uncached: Jedi sees the exact text and its result order is the ranking
+        try:
+            interpreter = jedi.Interpreter(code, [self._namespace(session_id)])
+            names = [c.name for c in interpreter.complete(line=line + 1, column=column)]
+        except Exception as e:
+            print(f"Completion error: {e}")
+            return []
+        return [{'name': name, 'score': round(1 - i / len(names), 3)} for i, name in enumerate(names)]
+
+    def get_completions(self, session_id, code, line, column):
+        # Strip the partially typed name at the cursor, so every keystroke within one name
+        # shares an index and only the first one reaches Jedi
+        lines = code.split('\n')
+        if line >= len(lines):
+            return []
+        row = lines[line]
+        partial = PARTIAL_NAME.search(row, 0, column).group()
+        start = column - len(partial)
+        if in_string(row[:start]):
+            # Dict keys come back with their opening quote (d["k -> '"key1"'), so they never
+            # match a name prefix; strings are rare enough to skip the index
+            return self._complete_directly(session_id, code, line, column)
+        lines[line] = row[:start] + row[column:]
+        context = '\n'.join(lines)
+        key = (session_id, hashlib.blake2b(context.encode(), digest_size=8).digest(), line, start)
+
+        index = self._completion_index.get(key)
+        if index:
+            self._completion_index.move_to_end(key)
+        else:
+            try:
+                index = self._build_completion_index(session_id, context, line, start)
+            except Exception as e:
+                print(f"Completion error: {e}")
+                return []
+            self._completion_index[key] = index
+            if len(self._completion_index) > COMPLETION_CACHE_SIZE:
+                self._completion_index.popitem(last=False)
+
+        keys, entries = index
+        prefix = partial.lower() # Jedi matches names case-insensitively
+        matches = entries[bisect.bisect_left(keys, prefix):bisect.bisect_right(keys, prefix + chr(sys.maxunicode))]
+        # Same order Jedi gives for the typed prefix: case-sensitive prefix matches first, then
+        # its no-prefix ranking (dunder/private last, then by lowercased name)
+        if not matches and partial:
+            # Nothing in the index starts with the typed text; let Jedi's own matching have a go
+            return self._complete_directly(session_id, code, line, column)
+        matches.sort(key=lambda entry: (not entry[1].startswith(partial), entry[2]))
+        count = len(matches)
+        return [{'name': name, 'score': round(1 - i / count, 3)} for i, (_, name, _) in enumerate(matches)]
+
+kernel = Kernel()
+
+# Entry points for ProcessPoolExecutor.submit; they have to be module-level to pickle
+def kernel_execute(session_id, code):
+    return kernel.execute(session_id, code)
+
+def kernel_complete(session_id, code, line, column):
+    return kernel.get_completions(session_id, code, line, column)
+
+def kernel_drop(session_id):
+    kernel.drop(session_id)
 
 # --- Notebook Server (Refactored for Sessions) ---
+# One single-process pool per shard: a session's namespace lives in exactly one worker
+EXEC_WORKERS = os.cpu_count() or 1
+# A cell running longer than this gets its worker killed and restarted. Calls are submitted
+# one at a time per shard, so the timer only counts the cell's own run time.
+CELL_TIMEOUT = 60
+# Jedi evaluates properties while inferring types, so completions can run user code too
+COMPLETION_TIMEOUT = 5
+# Forking a process that runs an event loop and threads is unsafe; start workers fresh
+EXEC_MP_CONTEXT = multiprocessing.get_context('spawn')
+# Outbound messages queued within this window go out together as one JSON array frame
+OUTBOX_FLUSH_DELAY = 0.005
+OUTBOX_MAX_BATCH = 32
+# Sessions whose socket has gone away without a clean disconnect are evicted after this long
+# to bound namespace memory. Live sockets are never evicted, however long the user idles.
+SESSION_IDLE_TIMEOUT = 30 * 60
+SESSION_GC_INTERVAL = 60
+
+@dataclass
+class Session:
+    websocket: WebSocket
+    outbox: asyncio.Queue = field(default_factory=asyncio.Queue)
+    writer: asyncio.Task = None
+    # Serializes code execution and completions, which both touch the namespace
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    last_seen: float = field(default_factory=time.monotonic)
+
+def kill_executor(executor):
+    # ProcessPoolExecutor cannot stop a running call, so kill the worker outright.
+    # Anything still queued on it fails with BrokenProcessPool.
+    for process in list((executor._processes or {}).values()):
+        process.kill()
+    executor.shutdown(wait=False, cancel_futures=True)
+
 class NotebookServer:
     def __init__(self):
         # Each session_id gets its own execution context
         self.sessions = {}
+        self._pending_completion = {}
+        # Executors are started on first use, so idle shards cost no processes
+        self._shards = [None] * EXEC_WORKERS
+        # Held from submit until the worker is free again; the backlog waits on the event loop
+        self._shard_locks = [asyncio.Lock() for _ in range(EXEC_WORKERS)]
+        self._gc_task = None
 
     async def connect(self, websocket: WebSocket, session_id: str):
         await websocket.accept()
         # Create a new environment for each notebook session
         if session_id not in self.sessions:
-            self.sessions[session_id] = {
-                'locals': {'plt': plt, 'pd': pd},
-                'websocket': websocket
-            }
+            session = Session(websocket=websocket)
+            session.writer = asyncio.create_task(self._writer(websocket, session.outbox))
+            self.sessions[session_id] = session
+        if self._gc_task is None:
+            self._gc_task = asyncio.create_task(self._gc())
         print(f"Client connected: {session_id}")
 
     def disconnect(self, session_id: str):
+        pending = self._pending_completion.pop(session_id, None)
+        if pending:
+            pending.cancel()
+        executor = self._shards[self._shard_index(session_id)]
+        if executor is not None:
+            try:
+                executor.submit(kernel_drop, session_id)
+            except RuntimeError:
+                pass # Worker was recycled, so the namespace is already gone
         if session_id in self.sessions:
-            del self.sessions[session_id]
+            self.sessions.pop(session_id).writer.cancel()
             print(f"Client disconnected: {session_id}")
 
+    def close(self):
+        for executor in self._shards:
+            if executor is not None:
+                kill_executor(executor)
+        self._shards = [None] * EXEC_WORKERS
+
     async def handle_message(self, websocket: WebSocket, session_id: str, message: str):
-        data = json.loads(message)
+        data = orjson.loads(message)
         msg_type = data.get('type')
-        loop = asyncio.get_event_loop()
+        session = self.sessions.get(session_id)
+        if not session:
+            return # Evicted; the socket is being closed
+        session.last_seen = time.monotonic()
 
         if msg_type == 'run_code':
-            output = await loop.run_in_executor(
-                None, self.execute, session_id, data['code']
-            )
-            await websocket.send_json({
+            async with session.lock:
+                output = await self.execute(session_id, data['code'])
+            self.queue_out(session_id, {
                 'type': 'output',
                 'cell_id': data['cell_id'],
                 'output': output
             })
         elif msg_type == 'get_completions':
-            # --- Teacher Control Logic ---
-            if not global_settings["enable_autocomplete"]:
-                completions = [] # Send empty list if disabled
-            else:
-                completions = self.get_completions(session_id, data['code'], data['line'], data['column'])
-            
-            await websocket.send_json({
-                'type': 'completions',
-                'request_id': data.get('request_id'),
-                'completions': completions
-            })
+            # A newer keystroke supersedes whatever is still in flight for this session
+            previous = self._pending_completion.pop(session_id, None)
+            if previous:
+                previous.cancel()
+            self._pending_completion[session_id] = asyncio.create_task(
+                self._send_completions(session_id, data)
+            )
         elif msg_type == 'apply_design':
-            notebook_session_id = data.get('session_id')
-            target_ws = self.sessions.get(notebook_session_id, {}).get('websocket')
-            if target_ws:
-                await target_ws.send_json({
-                    'type': 'design_applied',
-                    'html': data['html']
-                })
-
-    def execute(self, session_id, code):
-        # Get the correct 'locals' for this session
-        session_env = self.sessions.get(session_id)
-        if not session_env:
-            return '<div class="error">Session expired. Please refresh.</div>'
-        
-        session_locals = session_env['locals']
-        
-        buf = io.StringIO()
-        with redirect_stdout(buf):
+            self.broadcast({
+                'type': 'design_applied',
+                'html': data['html']
+            }, sessions=[data.get('session_id')])
+
+    def queue_out(self, session_id: str, payload: dict):
+        session = self.sessions.get(session_id)
+        if session:
+            session.outbox.put_nowait(orjson.dumps(payload).decode())
+
+    def broadcast(self, payload: dict, sessions=None):
+        # Encode once and queue the same message for every target (all sessions by default)
+        message = orjson.dumps(payload).decode()
+        for sid, session in list(self.sessions.items()):
+            if sessions is None or sid in sessions:
+                session.outbox.put_nowait(message)
+
+    async def _writer(self, websocket: WebSocket, outbox: asyncio.Queue):
+        # Coalesce whatever arrives within OUTBOX_FLUSH_DELAY of the first message into one frame
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await outbox.get()]
+            deadline = loop.time() + OUTBOX_FLUSH_DELAY
+            while len(batch) < OUTBOX_MAX_BATCH:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(outbox.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
             try:
-                tree = ast.parse(code)
-                if tree.body and isinstance(tree.body[-1], ast.Expr):
-                    if len(tree.body) > 1:
-                        exec_code = compile(ast.Module(tree.body[:-1], type_ignores=[]), '<string>', 'exec')
-                        exec(exec_code, session_locals)
-                    eval_code = compile(ast.Expression(tree.body[-1].value), '<string>', 'eval')
-                    result = eval(eval_code, session_locals)
-                    if isinstance(result, pd.DataFrame):
-                        buf.write(result.to_html())
-                    elif result is not None:
-                        buf.write(escape(str(result))) # Escape for XSS protection
-                else:
-                    exec(code, session_locals)
-                fig = plt.gcf()
-                if fig.axes:
-                    img_buf = io.BytesIO()
-                    fig.savefig(img_buf, format='png', bbox_inches='tight')
-                    img_buf.seek(0)
-                    plt.close(fig)
-                    img_html = base64.b64encode(img_buf.read()).decode()
-                    buf.write(f'<img src="data:image/png;base64,{img_html}"><br>')
+                await websocket.send_text('[' + ','.join(batch) + ']')
             except Exception:
-                import traceback
-                buf.truncate(0)
-                buf.seek(0)
-                tb = traceback.format_exc()
-                buf.write(f'<div class="error">{escape(tb)}</div>')
-        return buf.getvalue()
+                return # Socket is gone; disconnect() cleans up the session
 
-    def get_completions(self, session_id, code, line, column):
-        session_locals = self.sessions.get(session_id, {}).get('locals')
-        if not session_locals:
-            return []
+    async def _gc(self):
+        while True:
+            await asyncio.sleep(SESSION_GC_INTERVAL)
+            cutoff = time.monotonic() - SESSION_IDLE_TIMEOUT
+            for session_id, session in list(self.sessions.items()):
+                if session.last_seen < cutoff and not session.lock.locked() and not self._connected(session):
+                    self.disconnect(session_id)
+                    try:
+                        await session.websocket.close()
+                    except Exception:
+                        pass # Already closed by the client
+
+    def _connected(self, session):
+        websocket = session.websocket
+        return (websocket.client_state == WebSocketState.CONNECTED
+                and websocket.application_state == WebSocketState.CONNECTED)
+
+    def _shard_index(self, session_id):
+        # Stable across restarts, unlike hash() on str
+        return zlib.crc32(session_id.encode()) % EXEC_WORKERS
+
+    async def _call_kernel(self, session_id, fn, *args, timeout=None):
+        index = self._shard_index(session_id)
+        async with self._shard_locks[index]:
+            executor = self._shards[index]
+            if executor is None:
+                executor = self._shards[index] = ProcessPoolExecutor(max_workers=1, mp_context=EXEC_MP_CONTEXT)
+            future = executor.submit(fn, session_id, *args)
+            try:
+                return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+            except (asyncio.TimeoutError, BrokenProcessPool):
+                self._recycle(index, executor)
+                raise
+            except asyncio.CancelledError:
+                # A superseded completion can't be stopped once running; keep the shard until it
+                # finishes so the next call's timer doesn't start while the worker is still busy.
+                # If it outlives its own timeout, the worker is stuck: recycle it before letting go.
+                if not future.cancel():
+                    waiter = asyncio.wrap_future(future)
+                    try:
+                        await asyncio.wait([waiter], timeout=timeout)
+                    finally:
+                        if not future.done():
+                            self._recycle(index, executor)
+                            waiter.cancel() # Nobody will read its BrokenProcessPool
+                raise
+
+    def _recycle(self, index, executor):
+        # Every session pinned to this shard loses its namespace; the next call starts a fresh worker
+        if self._shards[index] is executor:
+            self._shards[index] = None
+            kill_executor(executor)
+
+    async def execute(self, session_id, code):
         try:
-            interpreter = jedi.Interpreter(code, [session_locals])
-            completions = interpreter.complete(line=line + 1, column=column)
-            return [c.name for c in completions]
-        except Exception as e:
-            print(f"Completion error: {e}")
-            return []
+            return await self._call_kernel(session_id, kernel_execute, code, timeout=CELL_TIMEOUT)
+        except asyncio.TimeoutError:
+            return (f'<div class="error">Cell did not finish within {CELL_TIMEOUT} seconds and was stopped. '
+                    'The kernel restarted, so re-run earlier cells to restore your variables.</div>')
+        except BrokenProcessPool:
+            return ('<div class="error">The kernel restarted before this cell finished. '
+                    'Re-run earlier cells to restore your variables.</div>')
+
+    async def _send_completions(self, session_id: str, data: dict):
+        # --- Teacher Control Logic ---
+        if not global_settings["enable_autocomplete"]:
+            completions = [] # Send empty list if disabled
+        else:
+            session = self.sessions.get(session_id)
+            if not session:
+                return
+            async with session.lock:
+                try:
+                    completions = await self._call_kernel(
+                        session_id, kernel_complete, data['code'], data['line'], data['column'],
+                        timeout=COMPLETION_TIMEOUT
+                    )
+                except (asyncio.TimeoutError, BrokenProcessPool):
+                    completions = [] # The worker was recycled
+
+        if self._pending_completion.get(session_id) is not asyncio.current_task():
+            return # Superseded while Jedi was running
+        del self._pending_completion[session_id]
+
+        self.queue_out(session_id, {
+            'type': 'completions',
+            'request_id': data.get('request_id'),
+            'completions': completions
+        })
 
 server = NotebookServer()
 
 # --- Authentication & API Endpoints ---
 
+class LoginRequired(Exception):
+    pass
+
+def require_role(*roles, redirect=False):
+    # Dependency returning the verified session; with no roles any logged-in user passes.
+    # Pages pass redirect=True to send visitors to /login instead of answering 403.
+    def dependency(request: Request):
+        session = request.state.session
+        if not session or (roles and session['role'] not in roles):
+            if redirect:
+                raise LoginRequired()
+            raise HTTPException(status_code=403, detail="Unauthorized")
+        return session
+    return dependency
+
+@app.exception_handler(LoginRequired)
+async def login_required_handler(request: Request, exc: LoginRequired):
+    return RedirectResponse(url="/login")
+
+@app.exception_handler(StarletteHTTPException)
+async def http_error_handler(request: Request, exc: StarletteHTTPException):
+    return ORJSONResponse({"status": "error", "message": exc.detail}, status_code=exc.status_code)
+
+# Middleware that verifies the signed session once per request and stores it on request.state.
+# It also rejects user_id/user_role cookies the session doesn't back. Checking the signature
+# is a single HMAC, so no request needs a DB lookup to authenticate.
+@app.middleware("http")
+async def verify_session_cookie(request: Request, call_next):
+    session = read_session(request.cookies.get("session"))
+    request.state.session = session
+    user_id = request.cookies.get("user_id")
+    user_role = request.cookies.get("user_role")
+    if (user_id or user_role) and request.url.path not in ("/login", "/logout"):
+        if not session or (str(session['id']), session['role']) != (user_id, user_role):
+            if request.method == "GET" and not request.url.path.startswith("/api/"):
+                response = RedirectResponse(url="/login")
+            else:
+                response = ORJSONResponse({"status": "error", "message": "Session expired. Please log in again."}, status_code=401)
+            for key in ("user_id", "user_role", "session"):
+                response.delete_cookie(key)
+            return response
+    return await call_next(request)
+
 # Middleware to add no-cache headers
 @app.middleware("http")
 async def add_no_cache_headers(request: Request, call_next):
@@ -266,8 +777,8 @@ async def add_no_cache_headers(request: Request, call_next):
 # Login Page
 @app.get("/login", response_class=HTMLResponse)
 async def get_login_page():
-    with open("login.html", "r", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+    # Starlette streams the file with sendfile(2) where the platform supports it
+    return FileResponse("login.html", media_type="text/html")
 
 # Login Logic
 @app.post("/login")
@@ -276,20 +787,36 @@ async def handle_login(request: Request):
     username = form.get("username")
     password = form.get("password")
     
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
-    user = cursor.fetchone()
-    conn.close()
+    def authenticate():
+        # scrypt is deliberately slow: run it in the threadpool, but not while holding a pooled connection
+        with get_db_conn() as conn:
+            user = conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
+        if not user or not password or not verify_password(password, user["password"]):
+            return None
+        if is_legacy_hash(user["password"]):
+            new_hash = hash_password(password)
+            with get_db_conn() as conn:
+                conn.execute("UPDATE users SET password = ? WHERE id = ?", (new_hash, user["id"]))
+                conn.commit()
+        return user
+
+    user = await run_in_threadpool(authenticate)
     
-    if user and user["password"] == hash_password(password):
-        response = JSONResponse({"status": "ok", "role": user["role"]})
+    if user:
+        response = ORJSONResponse({"status": "ok", "role": user["role"]})
         # Set HttpOnly cookies for security
         response.set_cookie(key="user_id", value=str(user["id"]), httponly=True, samesite="strict")
         response.set_cookie(key="user_role", value=user["role"], samesite="strict")
+        session = {"id": user["id"], "role": user["role"]}
+        if user["role"] == 'student':
+            # Lets /api/student/assignments filter without looking the student up again
+            session["semesters"] = split_csv(user["semesters"])
+            session["subjects"] = split_csv(user["subjects"])
+        response.set_cookie(key="session", value=sign_session(session),
+                            max_age=SESSION_MAX_AGE, httponly=True, samesite="strict")
         return response
     
-    return JSONResponse({"status": "error", "message": "Invalid username or password"}, status_code=401)
+    return ORJSONResponse({"status": "error", "message": "Invalid username or password"}, status_code=401)
 
 # Logout
 @app.get("/logout")
@@ -297,21 +824,16 @@ async def logout():
     response = RedirectResponse(url="/login")
     response.delete_cookie("user_id")
     response.delete_cookie("user_role")
+    response.delete_cookie("session")
     return response
 
 # --- Admin Panel ---
 @app.get("/admin", response_class=HTMLResponse)
-async def get_admin_panel(user_role: str = Cookie(None)):
-    if user_role != 'admin':
-        return RedirectResponse(url="/login")
-    with open("admin_panel.html", "r", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+async def get_admin_panel(current_user: dict = Depends(require_role('admin', redirect=True))):
+    return FileResponse("admin_panel.html", media_type="text/html")
 
 @app.post("/api/admin/create_user")
-async def admin_create_user(request: Request, user_role: str = Cookie(None)):
-    if user_role != 'admin':
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
-    
+async def admin_create_user(request: Request, current_user: dict = Depends(require_role('admin'))):
     form = await request.json()
     username = form.get("username")
     password = form.get("password")
@@ -321,50 +843,46 @@ async def admin_create_user(request: Request, user_role: str = Cookie(None)):
     subjects = form.get("subjects", "")
     
     if not all([username, password, role, name]):
-        return JSONResponse({"status": "error", "message": "Username, password, name, and role are required"}, status_code=400)
+        return ORJSONResponse({"status": "error", "message": "Username, password, name, and role are required"}, status_code=400)
     
-    conn = get_db_conn()
-    cursor = conn.cursor()
+    def insert_user():
+        hashed_password = hash_password(password) # Before checking out a connection; see authenticate()
+        with get_db_conn() as conn:
+            conn.execute(
+                "INSERT INTO users (username, password, role, name, semesters, subjects) VALUES (?, ?, ?, ?, ?, ?)",
+                (username, hashed_password, role, name, semesters, subjects)
+            )
+            conn.commit()
+
     try:
-        cursor.execute(
-            "INSERT INTO users (username, password, role, name, semesters, subjects) VALUES (?, ?, ?, ?, ?, ?)",
-            (username, hash_password(password), role, name, semesters, subjects)
-        )
-        conn.commit()
-        return JSONResponse({"status": "ok", "message": f"{role.capitalize()} '{username}' created."})
+        await run_in_threadpool(insert_user)
+        return ORJSONResponse({"status": "ok", "message": f"{role.capitalize()} '{username}' created."})
     except sqlite3.IntegrityError:
-        return JSONResponse({"status": "error", "message": "Username already exists"}, status_code=400)
-    finally:
-        conn.close()
+        return ORJSONResponse({"status": "error", "message": "Username already exists"}, status_code=400)
 
 @app.get("/api/admin/users")
-async def admin_get_users(user_role: str = Cookie(None)):
-    if user_role != 'admin':
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
-    
-    conn = get_db_conn()
-    users = conn.execute("SELECT id, username, role, name, semesters, subjects FROM users").fetchall()
-    conn.close()
-    return JSONResponse([dict(user) for user in users])
+async def admin_get_users(current_user: dict = Depends(require_role('admin'))):
+    def fetch_users():
+        with get_db_conn() as conn:
+            return conn.execute("SELECT id, username, role, name, semesters, subjects FROM users").fetchall()
+
+    users = await run_in_threadpool(fetch_users)
+    return ORJSONResponse([dict(user) for user in users])
 
 @app.get("/api/admin/user/{user_id}")
-async def admin_get_user(user_id: int, user_role: str = Cookie(None)):
-    if user_role != 'admin':
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
-    
-    conn = get_db_conn()
-    user = conn.execute("SELECT id, username, role, name, semesters, subjects FROM users WHERE id = ?", (user_id,)).fetchone()
-    conn.close()
+async def admin_get_user(user_id: int, current_user: dict = Depends(require_role('admin'))):
+    def fetch_user():
+        with get_db_conn() as conn:
+            return conn.execute("SELECT id, username, role, name, semesters, subjects FROM users WHERE id = ?", (user_id,)).fetchone()
+
+    user = await run_in_threadpool(fetch_user)
     
     if not user:
-        return JSONResponse({"status": "error", "message": "User not found"}, status_code=404)
-    return JSONResponse(dict(user))
+        return ORJSONResponse({"status": "error", "message": "User not found"}, status_code=404)
+    return ORJSONResponse(dict(user))
 
 @app.put("/api/admin/user/{user_id}")
-async def admin_update_user(user_id: int, request: Request, user_role: str = Cookie(None)):
-    if user_role != 'admin':
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
-        
+async def admin_update_user(user_id: int, request: Request, current_user: dict = Depends(require_role('admin'))):
     form = await request.json()
     name = form.get("name")
     role = form.get("role")
@@ -372,172 +890,168 @@ async def admin_update_user(user_id: int, request: Request, user_role: str = Coo
     subjects = form.get("subjects", "")
 
     if not all([name, role]):
-        return JSONResponse({"status": "error", "message": "Name and role are required"}, status_code=400)
+        return ORJSONResponse({"status": "error", "message": "Name and role are required"}, status_code=400)
 
-    conn = get_db_conn()
-    conn.execute(
-        "UPDATE users SET name = ?, role = ?, semesters = ?, subjects = ? WHERE id = ?",
-        (name, role, semesters, subjects, user_id)
-    )
-    conn.commit()
-    conn.close()
-    return JSONResponse({"status": "ok", "message": "User updated successfully."})
+    def update_user():
+        with get_db_conn() as conn:
+            conn.execute(
+                "UPDATE users SET name = ?, role = ?, semesters = ?, subjects = ? WHERE id = ?",
+                (name, role, semesters, subjects, user_id)
+            )
+            conn.commit()
+
+    await run_in_threadpool(update_user)
+    _teacher_info_cache.pop(user_id, None)
+    return ORJSONResponse({"status": "ok", "message": "User updated successfully."})
 
 
 @app.delete("/api/admin/user/{user_id}")
-async def admin_delete_user(user_id: int, admin_user_id: str = Cookie(alias="user_id"), user_role: str = Cookie(None)):
-    if user_role != 'admin':
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
+async def admin_delete_user(user_id: int, current_user: dict = Depends(require_role('admin'))):
+    if current_user['id'] == user_id:
+        return ORJSONResponse({"status": "error", "message": "Admin cannot delete themselves."}, status_code=400)
+
+    def delete_user():
+        with get_db_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
+            conn.commit()
     
-    if int(admin_user_id) == user_id:
-        return JSONResponse({"status": "error", "message": "Admin cannot delete themselves."}, status_code=400)
+            if cursor.rowcount == 0:
+                return False
 
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
-    conn.commit()
-    
-    if cursor.rowcount > 0:
-        # Also delete related data for cleanliness
-        cursor.execute("DELETE FROM assignments WHERE teacher_id = ?", (user_id,))
-        cursor.execute("DELETE FROM submissions WHERE student_id = ?", (user_id,))
-        conn.commit()
-        return JSONResponse({"status": "ok", "message": "User deleted successfully."})
-    else:
-        conn.close()
-        return JSONResponse({"status": "error", "message": "User not found."}, status_code=404)
+            # Also delete related data for cleanliness
+            cursor.execute("DELETE FROM assignments WHERE teacher_id = ?", (user_id,))
+            cursor.execute("DELETE FROM submissions WHERE student_id = ?", (user_id,))
+            conn.commit()
+            return True
+
+    if not await run_in_threadpool(delete_user):
+        return ORJSONResponse({"status": "error", "message": "User not found."}, status_code=404)
+    _teacher_info_cache.pop(user_id, None)
+    return ORJSONResponse({"status": "ok", "message": "User deleted successfully."})
 
 
 # --- Ticket System ---
 
 @app.post("/api/ticket/create")
-async def create_ticket(request: Request, user_id: str = Cookie(None)):
-    if not user_id:
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
-    
+async def create_ticket(request: Request, current_user: dict = Depends(require_role())):
     data = await request.json()
     query_text = data.get("query_text")
     if not query_text:
-        return JSONResponse({"status": "error", "message": "Ticket query cannot be empty."}, status_code=400)
+        return ORJSONResponse({"status": "error", "message": "Ticket query cannot be empty."}, status_code=400)
+
+    def insert_ticket():
+        with get_db_conn() as conn:
+            conn.execute("INSERT INTO tickets (user_id, query_text) VALUES (?, ?)", (current_user['id'], query_text))
+            conn.commit()
 
-    conn = get_db_conn()
-    conn.execute("INSERT INTO tickets (user_id, query_text) VALUES (?, ?)", (int(user_id), query_text))
-    conn.commit()
-    conn.close()
-    return JSONResponse({"status": "ok", "message": "Ticket created successfully."})
+    await run_in_threadpool(insert_ticket)
+    return ORJSONResponse({"status": "ok", "message": "Ticket created successfully."})
 
 @app.get("/api/ticket/my_tickets")
-async def get_my_tickets(user_id: str = Cookie(None)):
-    if not user_id:
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
+async def get_my_tickets(current_user: dict = Depends(require_role())):
+    def fetch_tickets():
+        with get_db_conn() as conn:
+            return conn.execute("SELECT id, query_text, status, created_at, resolved_at FROM tickets WHERE user_id = ? ORDER BY created_at DESC", (current_user['id'],)).fetchall()
 
-    conn = get_db_conn()
-    tickets = conn.execute("SELECT id, query_text, status, created_at, resolved_at FROM tickets WHERE user_id = ? ORDER BY created_at DESC", (int(user_id),)).fetchall()
-    conn.close()
-    return JSONResponse([dict(t) for t in tickets])
+    tickets = await run_in_threadpool(fetch_tickets)
+    return ORJSONResponse([dict(t) for t in tickets])
 
 @app.get("/api/admin/tickets")
-async def admin_get_tickets(user_role: str = Cookie(None)):
-    if user_role != 'admin':
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
-
-    conn = get_db_conn()
-    tickets = conn.execute("""
-        SELECT t.id, t.query_text, t.status, t.created_at, u.username, u.name
-        FROM tickets t
-        JOIN users u ON t.user_id = u.id
-        ORDER BY t.created_at DESC
-    """).fetchall()
-    conn.close()
-    return JSONResponse([dict(t) for t in tickets])
+async def admin_get_tickets(current_user: dict = Depends(require_role('admin'))):
+    def fetch_tickets():
+        with get_db_conn() as conn:
+            return conn.execute("""
+                SELECT t.id, t.query_text, t.status, t.created_at, u.username, u.name
+                FROM tickets t
+                JOIN users u ON t.user_id = u.id
+                ORDER BY t.created_at DESC
+            """).fetchall()
+
+    tickets = await run_in_threadpool(fetch_tickets)
+    return ORJSONResponse([dict(t) for t in tickets])
 
 @app.post("/api/admin/ticket/close/{ticket_id}")
-async def admin_close_ticket(ticket_id: int, user_role: str = Cookie(None)):
-    if user_role != 'admin':
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
+async def admin_close_ticket(ticket_id: int, current_user: dict = Depends(require_role('admin'))):
+    def close_ticket():
+        with get_db_conn() as conn:
+            conn.execute("UPDATE tickets SET status = 'closed', resolved_at = CURRENT_TIMESTAMP WHERE id = ?", (ticket_id,))
+            conn.commit()
 
-    conn = get_db_conn()
-    conn.execute("UPDATE tickets SET status = 'closed', resolved_at = CURRENT_TIMESTAMP WHERE id = ?", (ticket_id,))
-    conn.commit()
-    conn.close()
-    return JSONResponse({"status": "ok", "message": "Ticket closed."})
+    await run_in_threadpool(close_ticket)
+    return ORJSONResponse({"status": "ok", "message": "Ticket closed."})
 
 
 # --- Teacher Dashboard ---
 @app.get("/teacher", response_class=HTMLResponse)
-async def get_teacher_dashboard(user_role: str = Cookie(None)):
-    if user_role != 'teacher':
-        return RedirectResponse(url="/login")
-    with open("teacher_dashboard.html", "r", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+async def get_teacher_dashboard(current_user: dict = Depends(require_role('teacher', redirect=True))):
+    return FileResponse("teacher_dashboard.html", media_type="text/html")
 
 @app.post("/api/teacher/assignment")
-async def create_assignment(request: Request, user_id: str = Cookie(None), user_role: str = Cookie(None)):
-    if user_role != 'teacher':
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
-    
+async def create_assignment(request: Request, current_user: dict = Depends(require_role('teacher'))):
     data = await request.json()
     title = data.get("title")
     questions = data.get("questions") # Expects a JSON string
     semester = data.get("semester")
     subject = data.get("subject")
     
-    conn = get_db_conn()
-    conn.execute("INSERT INTO assignments (teacher_id, title, questions, semester, subject) VALUES (?, ?, ?, ?, ?)",
-                 (int(user_id), title, questions, semester, subject))
-    conn.commit()
-    conn.close()
-    return JSONResponse({"status": "ok", "message": "Assignment posted"})
+    def insert_assignment():
+        with get_db_conn() as conn:
+            conn.execute("INSERT INTO assignments (teacher_id, title, questions, semester, subject) VALUES (?, ?, ?, ?, ?)",
+                         (current_user['id'], title, questions, semester, subject))
+            conn.commit()
+
+    await run_in_threadpool(insert_assignment)
+    return ORJSONResponse({"status": "ok", "message": "Assignment posted"})
 
 @app.get("/api/teacher/info")
-async def get_teacher_info(user_id: str = Cookie(None), user_role: str = Cookie(None)):
-    if user_role != 'teacher':
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
-    
-    conn = get_db_conn()
-    teacher = conn.execute("SELECT semesters, subjects FROM users WHERE id = ?", (int(user_id),)).fetchone()
-    conn.close()
+async def get_teacher_info(current_user: dict = Depends(require_role('teacher'))):
+    cached = _teacher_info_cache.get(current_user['id'])
+    if cached and cached[0] > time.monotonic():
+        return ORJSONResponse(cached[1])
+
+    def fetch_teacher():
+        with get_db_conn() as conn:
+            return conn.execute("SELECT semesters, subjects FROM users WHERE id = ?", (current_user['id'],)).fetchone()
+
+    teacher = await run_in_threadpool(fetch_teacher)
     
     if not teacher:
-        return JSONResponse({"status": "error", "message": "Teacher not found"}, status_code=404)
+        return ORJSONResponse({"status": "error", "message": "Teacher not found"}, status_code=404)
         
-    return JSONResponse({
-        "semesters": [s.strip() for s in teacher['semesters'].split(',')] if teacher['semesters'] else [],
-        "subjects": [s.strip() for s in teacher['subjects'].split(',')] if teacher['subjects'] else []
-    })
+    info = {
+        "semesters": split_csv(teacher['semesters']),
+        "subjects": split_csv(teacher['subjects'])
+    }
+    _teacher_info_cache[current_user['id']] = (time.monotonic() + TEACHER_INFO_TTL, info)
+    return ORJSONResponse(info)
 
 @app.get("/api/teacher/assignments")
-async def get_teacher_assignments(user_id: str = Cookie(None), user_role: str = Cookie(None)):
-    if user_role != 'teacher':
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
-    
-    conn = get_db_conn()
-    assignments = conn.execute("SELECT id, title, created_at FROM assignments WHERE teacher_id = ?", (int(user_id),)).fetchall()
-    conn.close()
-    return JSONResponse([dict(a) for a in assignments])
+async def get_teacher_assignments(current_user: dict = Depends(require_role('teacher'))):
+    def fetch_assignments():
+        with get_db_conn() as conn:
+            return conn.execute("SELECT id, title, created_at FROM assignments WHERE teacher_id = ?", (current_user['id'],)).fetchall()
+
+    assignments = await run_in_threadpool(fetch_assignments)
+    return ORJSONResponse([dict(a) for a in assignments])
 
 @app.get("/api/teacher/submissions/{assignment_id}")
-async def get_submissions_for_assignment(assignment_id: int, user_role: str = Cookie(None)):
-    if user_role != 'teacher':
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
-        
-    conn = get_db_conn()
-    submissions = conn.execute("""
-        SELECT s.id, s.submitted_at, u.username 
-        FROM submissions s
-        JOIN users u ON s.student_id = u.id
-        WHERE s.assignment_id = ?
-    """, (assignment_id,)).fetchall()
-    conn.close()
-    return JSONResponse([dict(s) for s in submissions])
+async def get_submissions_for_assignment(assignment_id: int, current_user: dict = Depends(require_role('teacher'))):
+    def fetch_submissions():
+        with get_db_conn() as conn:
+            return conn.execute("""
+                SELECT s.id, s.submitted_at, u.username 
+                FROM submissions s
+                JOIN users u ON s.student_id = u.id
+                WHERE s.assignment_id = ?
+            """, (assignment_id,)).fetchall()
+
+    submissions = await run_in_threadpool(fetch_submissions)
+    return ORJSONResponse([dict(s) for s in submissions])
 
 # This new endpoint provides all data needed for the review page
 @app.get("/api/submission_details/{submission_id}")
-async def get_submission_details(submission_id: int, user_id: str = Cookie(None), user_role: str = Cookie(None)):
-    if not user_role:
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
-
-    conn = get_db_conn()
+async def get_submission_details(submission_id: int, current_user: dict = Depends(require_role())):
     # Security check: if student, they must own the submission. Teacher can see any.
     query = """
         SELECT s.id, s.student_id, s.answers, s.grades, a.questions, a.title
@@ -547,204 +1061,190 @@ async def get_submission_details(submission_id: int, user_id: str = Cookie(None)
     """
     params = (submission_id,)
     
-    submission = conn.execute(query, params).fetchone()
+    def fetch_submission():
+        with get_db_conn() as conn:
+            return conn.execute(query, params).fetchone()
+
+    submission = await run_in_threadpool(fetch_submission)
 
     if not submission:
-        conn.close()
-        return JSONResponse({"status": "error", "message": "Submission not found"}, status_code=404)
+        return ORJSONResponse({"status": "error", "message": "Submission not found"}, status_code=404)
 
     # If student, verify ownership
-    if user_role == 'student' and submission['student_id'] != int(user_id):
-        conn.close()
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
+    if current_user['role'] == 'student' and submission['student_id'] != current_user['id']:
+        return ORJSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
         
-    conn.close()
-    return JSONResponse(dict(submission))
+    submission = dict(submission)
+    # The review page JSON.parses these, so hand them back as text
+    submission['answers'] = json_text(submission['answers'])
+    submission['grades'] = json_text(submission['grades'])
+    return ORJSONResponse(submission)
 
 
 @app.post("/api/teacher/grade_submission")
-async def grade_submission(request: Request, user_role: str = Cookie(None)):
-    if user_role != 'teacher':
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
-    
+async def grade_submission(request: Request, current_user: dict = Depends(require_role('teacher'))):
     data = await request.json()
     submission_id = data.get('submission_id')
     question_index = data.get('question_index')
     status = data.get('status') # "correct" or "wrong"
 
-    conn = get_db_conn()
-    
-    # Get existing grades and assignment questions
-    submission = conn.execute("SELECT s.grades, a.questions FROM submissions s JOIN assignments a ON s.assignment_id = a.id WHERE s.id = ?", (submission_id,)).fetchone()
-    if not submission:
-        conn.close()
-        return JSONResponse({"status": "error", "message": "Submission not found"}, status_code=404)
+    def save_grade():
+        with get_db_conn() as conn:
+            # Get existing grades and assignment questions
+            submission = conn.execute("SELECT s.grades, a.questions FROM submissions s JOIN assignments a ON s.assignment_id = a.id WHERE s.id = ?", (submission_id,)).fetchone()
+            if not submission:
+                return False
 
-    grades = json.loads(submission['grades'] or '[]')
-    questions = json.loads(submission['questions'])
+            grades = orjson.loads(json_text(submission['grades']) or '[]')
+            questions = orjson.loads(submission['questions'])
     
-    # Get the score for the graded question
-    score = questions[question_index]['marks'] if status == 'correct' else 0
+            # Get the score for the graded question
+            score = questions[question_index]['marks'] if status == 'correct' else 0
     
-    # Update or add the grade for the specific question
-    grade_found = False
-    for grade in grades:
-        if grade.get('question_index') == question_index:
-            grade['status'] = status
-            grade['score'] = score
-            grade_found = True
-            break
+            # Update or add the grade for the specific question
+            grade_found = False
+            for grade in grades:
+                if grade.get('question_index') == question_index:
+                    grade['status'] = status
+                    grade['score'] = score
+                    grade_found = True
+                    break
     
-    if not grade_found:
-        grades.append({'question_index': question_index, 'status': status, 'score': score})
+            if not grade_found:
+                grades.append({'question_index': question_index, 'status': status, 'score': score})
+
+            conn.execute("UPDATE submissions SET grades = ? WHERE id = ?", (compress_json(grades), submission_id))
+            conn.commit()
+            return True
 
-    conn.execute("UPDATE submissions SET grades = ? WHERE id = ?", (json.dumps(grades), submission_id))
-    conn.commit()
-    conn.close()
+    if not await run_in_threadpool(save_grade):
+        return ORJSONResponse({"status": "error", "message": "Submission not found"}, status_code=404)
     
-    return JSONResponse({"status": "ok", "message": "Grade updated."})
+    return ORJSONResponse({"status": "ok", "message": "Grade updated."})
 
 
 @app.post("/api/teacher/settings")
-async def update_settings(request: Request, user_role: str = Cookie(None)):
-    if user_role != 'teacher':
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
-    
+async def update_settings(request: Request, current_user: dict = Depends(require_role('teacher'))):
+    global settings_version
     data = await request.json()
     if 'enable_autocomplete' in data:
-        global_settings['enable_autocomplete'] = bool(data['enable_autocomplete'])
+        enabled = bool(data['enable_autocomplete'])
+        if enabled != global_settings['enable_autocomplete']:
+            global_settings['enable_autocomplete'] = enabled
+            settings_version += 1
+            # Push the change to open notebooks instead of having them poll /api/teacher/settings
+            server.broadcast({'type': 'settings', 'settings': global_settings})
     
-    return JSONResponse({"status": "ok", "settings": global_settings})
+    return ORJSONResponse({"status": "ok", "settings": global_settings})
 
 @app.get("/api/teacher/settings")
-async def get_settings(user_role: str = Cookie(None)):
+async def get_settings(current_user: dict = Depends(require_role())):
     # Any logged-in user can get settings, as it affects the notebook
-    if not user_role:
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
-    return JSONResponse(global_settings)
+    global _settings_body
+    if _settings_body[0] != settings_version:
+        _settings_body = (settings_version, orjson.dumps(global_settings))
+    return Response(content=_settings_body[1], media_type="application/json")
 
 
 # --- Student Dashboard ---
 @app.get("/student", response_class=HTMLResponse)
-async def get_student_dashboard(user_role: str = Cookie(None)):
-    if user_role != 'student':
-        return RedirectResponse(url="/login")
-    with open("student_dashboard.html", "r", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+async def get_student_dashboard(current_user: dict = Depends(require_role('student', redirect=True))):
+    return FileResponse("student_dashboard.html", media_type="text/html")
 
 @app.get("/api/student/assignments")
-async def get_student_assignments(user_id: str = Cookie(None), user_role: str = Cookie(None)):
-    if user_role != 'student':
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
-    
-    conn = get_db_conn()
-    
-    # Get student's semesters and subjects
-    student = conn.execute("SELECT semesters, subjects FROM users WHERE id = ?", (int(user_id),)).fetchone()
-    if not student:
-        conn.close()
-        return JSONResponse([])
-        
-    student_semesters = [s.strip() for s in student['semesters'].split(',')] if student['semesters'] else []
-    student_subjects = [s.strip() for s in student['subjects'].split(',')] if student['subjects'] else []
-    
-    if not student_semesters or not student_subjects:
-        conn.close()
-        return JSONResponse([])
-
-    semester_placeholders = ','.join('?' for _ in student_semesters)
-    subject_placeholders = ','.join('?' for _ in student_subjects)
-
-    # Get all assignments this student has NOT submitted and are for their semester and subject
-    query = f"""
+async def get_student_assignments(current_user: dict = Depends(require_role('student'))):
+    # Get all assignments this student has NOT submitted and are for their semester and subject.
+    # The lists are bound as JSON arrays so the SQL text stays identical between students.
+    query = """
         SELECT a.id, a.title, u.username as teacher_name
         FROM assignments a
         JOIN users u ON a.teacher_id = u.id
-        WHERE a.id NOT IN (
-            SELECT s.assignment_id FROM submissions s WHERE s.student_id = ?
-        ) AND a.semester IN ({semester_placeholders}) AND a.subject IN ({subject_placeholders})
+        LEFT JOIN submissions s ON s.assignment_id = a.id AND s.student_id = ?
+        WHERE s.id IS NULL
+          AND a.semester IN (SELECT value FROM json_each(?))
+          AND a.subject IN (SELECT value FROM json_each(?))
     """
-    
-    params = [int(user_id)] + student_semesters + student_subjects
-    assignments = conn.execute(query, params).fetchall()
-    
-    conn.close()
-    return JSONResponse([dict(a) for a in assignments])
+
+    # The student's semesters and subjects travel in the signed session, set at login
+    student_semesters = current_user.get('semesters', [])
+    student_subjects = current_user.get('subjects', [])
+    if not student_semesters or not student_subjects:
+        return ORJSONResponse([])
+    params = (current_user['id'], orjson.dumps(student_semesters).decode(), orjson.dumps(student_subjects).decode())
+
+    def fetch_assignments():
+        with get_db_conn() as conn:
+            return conn.execute(query, params).fetchall()
+
+    assignments = await run_in_threadpool(fetch_assignments)
+    return ORJSONResponse([dict(a) for a in assignments])
 
 @app.get("/api/student/submissions")
-async def get_student_submissions(user_id: str = Cookie(None), user_role: str = Cookie(None)):
-    if user_role != 'student':
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
-    
-    conn = get_db_conn()
-    submissions = conn.execute("""
-        SELECT s.id, s.submitted_at, a.title
-        FROM submissions s
-        JOIN assignments a ON s.assignment_id = a.id
-        WHERE s.student_id = ?
-    """, (int(user_id),)).fetchall()
-    conn.close()
-    return JSONResponse([dict(s) for s in submissions])
+async def get_student_submissions(current_user: dict = Depends(require_role('student'))):
+    def fetch_submissions():
+        with get_db_conn() as conn:
+            return conn.execute("""
+                SELECT s.id, s.submitted_at, a.title
+                FROM submissions s
+                JOIN assignments a ON s.assignment_id = a.id
+                WHERE s.student_id = ?
+            """, (current_user['id'],)).fetchall()
+
+    submissions = await run_in_threadpool(fetch_submissions)
+    return ORJSONResponse([dict(s) for s in submissions])
 
 
 @app.get("/api/student/assignment/{assignment_id}")
-async def get_assignment_content(assignment_id: int, user_id: str = Cookie(None), user_role: str = Cookie(None)):
-    if user_role != 'student':
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
-    
-    conn = get_db_conn()
-    # Check if student already submitted
-    existing = conn.execute("SELECT id FROM submissions WHERE assignment_id = ? AND student_id = ?", (assignment_id, int(user_id))).fetchone()
+async def get_assignment_content(assignment_id: int, current_user: dict = Depends(require_role('student'))):
+    def fetch_assignment():
+        with get_db_conn() as conn:
+            # Check if student already submitted
+            existing = conn.execute("SELECT id FROM submissions WHERE assignment_id = ? AND student_id = ?", (assignment_id, current_user['id'])).fetchone()
+            if existing:
+                return existing, None
+            return None, conn.execute("SELECT questions FROM assignments WHERE id = ?", (assignment_id,)).fetchone()
+
+    existing, assignment = await run_in_threadpool(fetch_assignment)
     if existing:
-        conn.close()
-        return JSONResponse({"status": "error", "message": "You have already submitted this assignment."}, status_code=403)
+        return ORJSONResponse({"status": "error", "message": "You have already submitted this assignment."}, status_code=403)
     
-    assignment = conn.execute("SELECT questions FROM assignments WHERE id = ?", (assignment_id,)).fetchone()
-    conn.close()
     if assignment:
-        return JSONResponse(json.loads(assignment["questions"]))
-    return JSONResponse({"status": "error", "message": "Assignment not found"}, status_code=404)
+        return ORJSONResponse(orjson.loads(assignment["questions"]))
+    return ORJSONResponse({"status": "error", "message": "Assignment not found"}, status_code=404)
 
 @app.post("/api/student/submit/{assignment_id}")
-async def submit_assignment(assignment_id: int, request: Request, user_id: str = Cookie(None), user_role: str = Cookie(None)):
-    if user_role != 'student':
-        return JSONResponse({"status": "error", "message": "Unauthorized"}, status_code=403)
-    
+async def submit_assignment(assignment_id: int, request: Request, current_user: dict = Depends(require_role('student'))):
     data = await request.json()
     answers = data.get("answers") # Expects a JSON object
     
-    conn = get_db_conn()
-    # Check they haven't submitted already
-    existing = conn.execute("SELECT id FROM submissions WHERE assignment_id = ? AND student_id = ?", (assignment_id, int(user_id))).fetchone()
-    if existing:
-        conn.close()
-        return JSONResponse({"status": "error", "message": "Already submitted"}, status_code=400)
+    def insert_submission():
+        with get_db_conn() as conn:
+            # Check they haven't submitted already
+            existing = conn.execute("SELECT id FROM submissions WHERE assignment_id = ? AND student_id = ?", (assignment_id, current_user['id'])).fetchone()
+            if existing:
+                return False
 
-    conn.execute("INSERT INTO submissions (assignment_id, student_id, answers) VALUES (?, ?, ?)",
-                 (assignment_id, int(user_id), json.dumps(answers)))
-    conn.commit()
-    conn.close()
-    return JSONResponse({"status": "ok", "message": "Assignment submitted"})
+            conn.execute("INSERT INTO submissions (assignment_id, student_id, answers) VALUES (?, ?, ?)",
+                         (assignment_id, current_user['id'], compress_json(answers)))
+            conn.commit()
+            return True
+
+    if not await run_in_threadpool(insert_submission):
+        return ORJSONResponse({"status": "error", "message": "Already submitted"}, status_code=400)
+    return ORJSONResponse({"status": "ok", "message": "Assignment submitted"})
 
 
 # --- Your Existing Routes (Now Protected) ---
 
 # Root redirects to the correct dashboard
 @app.get("/", response_class=HTMLResponse)
-async def get_root(user_id: str = Cookie(None), user_role: str = Cookie(None)):
-    if not user_id:
-        return RedirectResponse(url="/login")
+async def get_root(current_user: dict = Depends(require_role(redirect=True))):
     # Redirect to the notebook page, which will handle its own logic
-    with open("index.html", "r", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+    return FileResponse("index.html", media_type="text/html")
 
 @app.get("/design", response_class=HTMLResponse)
-async def get_design(user_id: str = Cookie(None)):
-    if not user_id:
-        return RedirectResponse(url="/login")
-        
-    with open("design_animation.html", "r", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+async def get_design(current_user: dict = Depends(require_role(redirect=True))):
+    return FileResponse("design_animation.html", media_type="text/html")
 
 @app.websocket("/ws/{session_id}")
 async def websocket_endpoint(websocket: WebSocket, session_id: str):
@@ -754,28 +1254,42 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
             message = await websocket.receive_text()
             await server.handle_message(websocket, session_id, message)
     except WebSocketDisconnect:
+        pass
+    finally:
         server.disconnect(session_id)
     
 # /save endpoint (for local drafts by teachers)
 @app.post("/save")
-async def save_file(request: fastapi.Request, user_role: str = Cookie(None)):
-    if user_role not in ['admin', 'teacher']:
-        return JSONResponse({"status": "error", "message": "Only teachers can save local files."}, status_code=403)
-
+async def save_file(request: fastapi.Request, current_user: dict = Depends(require_role('admin', 'teacher'))):
     data = await request.json()
     filename = data.get("filename")
     content = data.get("content")
     
     if ".." in filename or os.path.isabs(filename):
-         return JSONResponse({"status": "error", "message": "Invalid filename"}, status_code=400)
+         return ORJSONResponse({"status": "error", "message": "Invalid filename"}, status_code=400)
     
     with open(filename, "w", encoding="utf-8") as f:
         f.write(content)
     return {"status": "ok", "message": f"File '{filename}' saved."}
 
+@app.on_event("startup")
+async def startup():
+    # No-op when init_db() already ran, but covers `uvicorn server:app` launches
+    init_db_pool()
+    # DB work runs in the threadpool; threads beyond DB_POOL_SIZE just wait for a free connection
+    anyio.to_thread.current_default_thread_limiter().total_tokens = min(32, (os.cpu_count() or 1) * 5)
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Don't let a stuck cell keep the process alive after uvicorn exits
+    server.close()
+
 if __name__ == "__main__":
     print("Initializing database...")
     init_db()
     print("Starting server...")
     print("Open http://localhost:8000 in your browser.")
-    uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
+    # uvloop and httptools ship with uvicorn[standard]; uvloop has no Windows build
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http = "httptools" if importlib.util.find_spec("httptools") else "h11"
+    uvicorn.run(app, host="127.0.0.1", port=8000, loop=loop, http=http)
\ No newline at end of file